@@ -22,12 +22,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 '''
 
-import time, math
+import time, math, struct
+import queue, threading
+from collections import deque
 
 import pygame, random
 import pygame.gfxdraw
 from pygame.locals import *
-from numpy import array
+import numpy as np
 
 
 BLACK = (0, 0, 0)
@@ -69,15 +71,987 @@ W_HEIGHT = 480
 SPEED = 2
 GRAVITY = .5
 
-class Main():
-    def __init__(self):
+# Entity kinds
+KIND_BALL = 0
+KIND_POLE = 1
+KIND_SCORE = 2
+KIND_SCENERY = 3
+KIND_TEXT = 4
+
+# Replay actions
+ACTION_TAP = 0
+ACTION_RESTART = 1
+
+# Profiler phases
+PHASES = ('input', 'update', 'collision', 'text', 'background', 'objects', 'sleep', 'present')
+(PHASE_INPUT, PHASE_UPDATE, PHASE_COLLISION, PHASE_TEXT,
+ PHASE_BACKGROUND, PHASE_OBJECTS, PHASE_SLEEP, PHASE_PRESENT) = range(len(PHASES))
+
+# Simulation events (bit flags returned by Simulation.step)
+EVENT_SPAWN = 1
+EVENT_SCORE = 2
+EVENT_FAIL = 4
+
+
+def _round(value):
+    # pygame.Rect stores float coordinates rounded half away from zero
+    return int(value + .5) if value >= 0 else -int(-value + .5)
+
+
+class Entity():
+    # Anything placed in the world; image is left to the renderer
+    __slots__ = ('kind', 'x', 'y', 'width', 'height', 'active', 'image')
+
+    def __init__(self, kind, x, y, width, height, image=None):
+        self.kind = kind
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.active = True
+        self.image = image
+
+
+class Ball(Entity):
+    __slots__ = ('radius', 'velo', 'accel')
+
+    def __init__(self, x, y, radius):
+        Entity.__init__(self, KIND_BALL, x, y, radius * 2, radius * 2)
+        self.radius = radius
+        self.velo = 1
+        self.accel = GRAVITY
+
+
+class Layout():
+    # Every size and position derived from a width x height playfield, worked
+    # out once; layout() keeps one table per size
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        portrait = width < height
+        # Ball and poles
+        self.ball_radius = int(width/12) if portrait else int(height/16)
+        self.ball_start = (int(width/2 - self.ball_radius), int(height/3))
+        self.pole_width = width/8 if portrait else int(height/12)
+        # Pole layouts: every gap size can open at every start
+        self.gap_sizes = [int(height/4), int(height/3), int(height/2)]
+        self.gap_starts = [int(height/4), int(height/3), int(height/5), int(height/6)]
+        # Scenery
+        self.horizon_y = int(7 * height/24)
+        self.ocean_y = int(height/3)
+        self.sand_y = int(7 * height/12)
+        self.wave_rows = (int(17 * height/48), int(27 * height/48))
+        self.wave_length = int(width/4)
+        self.wave_wrap = int(width/8)
+        self.wave_margin = int(width/32)
+        self.wave_crash_height = int(height/16)
+        self.sun_radius = int(width/8) if portrait else int(height/16)
+        self.sun_pos = (int(2 * width/3), int(height/16))
+        self.reflect_pos = (int(3 * width/5) if portrait else int(width/2), height/3)
+        self.reflect_size = (2 * width/5, height/4)
+        # Text
+        self.logo_y = int(height/2) - int(height/4)
+        self.start_y = int(height/2) + int(height/8)
+        self.retry_y = int(height/2)
+
+
+LAYOUTS = {}
+
+
+def layout(width, height):
+    if (width, height) not in LAYOUTS:
+        LAYOUTS[width, height] = Layout(width, height)
+    return LAYOUTS[width, height]
+
+
+class LevelStream():
+    # A course as (x, gap_start, gap_size) pole descriptors, in order, from an
+    # iterator of (gap_start, gap_size). Up to lookahead gaps are drawn ahead
+    # of use by fill(), from a worker thread if threaded, and prefetch(gap_start,
+    # gap_size) is called on each as it is buffered. Poles are spacing apart,
+    # the first at first past the origin given to restart(). A finite gaps
+    # iterator ends the course; an error raised by it comes out of peek()/pop().
+    # close() stops the worker thread.
+    def __init__(self, gaps, first, spacing, lookahead=16, prefetch=None, threaded=False):
+        self.gaps = gaps
+        self.first = first
+        self.spacing = spacing
+        self.lookahead = lookahead
+        self.prefetch = prefetch
+        self.buffer = deque()
+        self.next_x = first
+        self._queue = None
+        self._thread = None
+        self._closed = False
+        if threaded:
+            self._queue = queue.Queue(lookahead)
+            self._thread = threading.Thread(target=self._run, name='LevelStream')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        # Gaps, then None at the end, or the error the gaps iterator raised
+        try:
+            for gap in self.gaps:
+                if not self._put(gap):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(None)
+
+    def _put(self, item):
+        # Waits for room in the queue until the stream is closed
+        while not self._closed:
+            try:
+                self._queue.put(item, True, .1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _take(self, wait):
+        if self._closed:
+            return False
+        if self._queue is None:
+            gap = next(self.gaps, None)
+        else:
+            try:
+                gap = self._queue.get(wait)
+            except queue.Empty:
+                return False
+            if gap is None or isinstance(gap, Exception):
+                # The worker is done: keep an end marker for any later call
+                self._queue.put(None)
+            if isinstance(gap, Exception):
+                raise gap
+        if gap is None:
+            return False
+        self.buffer.append(gap)
+        if self.prefetch is not None:
+            self.prefetch(*gap)
+        return True
+
+    def close(self):
+        # No more gaps are drawn; buffered ones can still be popped
+        self._closed = True
+        if self._thread is not None:
+            self._thread.join(1)
+            self._thread = None
+
+    def restart(self, origin):
+        # Buffered gaps are kept, so the sequence carries on into the next run
+        self.next_x = origin + self.first
+
+    def fill(self):
+        # Top up the buffer; never waits for the worker thread
+        while len(self.buffer) < self.lookahead and self._take(False):
+            pass
+
+    def peek(self):
+        if not self.buffer and not self._take(True):
+            return None
+        return (self.next_x,) + tuple(self.buffer[0])
+
+    def pop(self):
+        pole = self.peek()
+        if pole is not None:
+            self.buffer.popleft()
+            self.next_x += self.spacing
+        return pole
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        pole = self.pop()
+        if pole is None:
+            raise StopIteration
+        return pole
+
+
+class Simulation():
+    # Game rules only: no window, font, mixer or Surface, so it runs headless
+    def __init__(self, rng=None, fps=60):
+        # Its own generator unless given one; never the global random module
+        self.rng = rng if rng is not None else random.Random()
+        self.FPS = fps
+        # The game is played on a W_WIDTH x W_HEIGHT field whatever the window size
+        self.layout = layout(W_WIDTH, W_HEIGHT)
+        self.gap_sizes = list(self.layout.gap_sizes)
+        self.gap_starts = list(self.layout.gap_starts)
+        self.pole_width = self.layout.pole_width
         self.state = STATE_INTRO
+        self.score = 0
+        self.ball = None
+        # Sorted by x; objects before index _passed are behind the ball
+        self.lvl_objects = deque()
+        self._passed = 0
+        self.spawned = []
+        self.ini_time = 0
+        # Poles stream in half a screen ahead of the ball: after a second's
+        # run-up, then every 1.5s (the +3/+1 match the old frame counters)
+        self.course = LevelStream(self.gaps(), SPEED * (int(fps) + int(3 * fps/2) + 3),
+                                  SPEED * (int(3 * fps/2) + 1))
+        # Optional FrameProfiler; step() then times collision separately
+        self.profiler = None
+
+    def create_ball(self):
+        self.ball = Ball(self.layout.ball_start[0], self.layout.ball_start[1], self.layout.ball_radius)
+
+    def gaps(self):
+        # The random course: endless (gap_start, gap_size) pairs drawn from rng
+        while True:
+            _sizes = self.gap_sizes
+            _starts = self.gap_starts
+            _gap_size = _sizes[self.rng.randint(0, len(_sizes) - 1)]
+            # y-position
+            _gap_start_pos = _starts[self.rng.randint(0, len(_starts) - 1)]
+            yield _gap_start_pos, _gap_size
+
+    def _reach(self):
+        # Poles are placed once this far ahead
+        return self.ball.x + self.ball.width + W_WIDTH/2
+
+    def _start_course(self):
+        self.course.restart(self._reach())
+        self.course.fill()
+
+    def add_poles(self, pos, gap_start, gap_size):
+        # pos must not be left of the last pole added, keeping lvl_objects sorted
+        _pole_width = self.pole_width
+        _bottom_size = W_HEIGHT - (gap_start + gap_size)
+        new_objects = [
+            Entity(KIND_POLE, int(pos), 0, int(_pole_width), gap_start),
+            Entity(KIND_POLE, int(pos), gap_start + gap_size, int(_pole_width), _bottom_size),
+            Entity(KIND_SCORE, int(pos + _pole_width/4), gap_start, int(_pole_width/2), gap_size)]
+        self.lvl_objects.extend(new_objects)
+        self.spawned.extend(new_objects)
+        return new_objects
+
+    def start(self):
+        self.create_ball()
+        self._start_course()
+        self.state = STATE_RUN
+
+    def reset(self):
+        self.ini_time = 0
+        self.score = 0
+        self.lvl_objects = deque()
+        self._passed = 0
+        self.spawned = []
+        self.create_ball()
+        self._start_course()
+
+    def restart(self):
+        self.reset()
+        self.state = STATE_RUN
+
+    def flap(self):
+        if self.state != STATE_RUN:
+            return False
+        self.ball.velo = -GRAVITY * 10
+        return True
+
+    def tap(self):
+        # A click or touch: start, retry or flap depending on the state
+        if self.state == STATE_INTRO:
+            self.start()
+        elif self.state == STATE_GAMEOVER:
+            self.restart()
+        else:
+            self.flap()
+
+    def collideball(self, rect):
+        # Exact circle/rect test: distance from the ball centre to the nearest
+        # point of the rect, clamped per axis
+        ball = self.ball
+        r = ball.radius
+        cx = ball.x + ball.width/2
+        cy = ball.y + ball.height/2
+        left, top = rect.x, rect.y
+        right, bottom = left + rect.width, top + rect.height
+        dx = left - cx if cx < left else (cx - right if cx > right else 0)
+        dy = top - cy if cy < top else (cy - bottom if cy > bottom else 0)
+        return dx * dx + dy * dy <= r * r
+
+    def _hit_ground(self):
+        # Same overlap test as the 1px ground rect along the bottom edge
+        ball = self.ball
+        return W_HEIGHT - 1 < ball.y + ball.height and ball.y < W_HEIGHT
+
+    def next_gap(self):
+        # Gap (y, height) of the nearest pole the ball has not passed; -1 if none.
+        # add_poles puts each top pole right before its bottom pole
+        objects = self.lvl_objects
+        for i in range(self._passed, len(objects)):
+            o = objects[i]
+            if o.kind == KIND_POLE and o.y == 0 and o.x + o.width > self.ball.x:
+                return o.height, objects[i + 1].y - o.height
+        return -1, -1
+
+    def step(self):
+        events = 0
+        self.spawned = []
+        ball = self.ball
+        # ball handling
+        if self.state == STATE_GAMEOVER and ball.y < W_HEIGHT - ball.height/2:
+            ball.velo += ball.accel
+            ball.y = max(_round(ball.y + ball.velo), -int(ball.height/2))
+        if self.state == STATE_RUN:
+            ball.velo += ball.accel
+            ball.x += SPEED
+            ball.y = max(_round(ball.y + ball.velo), -int(ball.height/2))
+            # Place the poles coming into reach; buffer the next ones on other frames
+            course = self.course
+            pole = course.peek()
+            while pole is not None and pole[0] <= self._reach():
+                self.add_poles(*course.pop())
+                events |= EVENT_SPAWN
+                pole = course.peek()
+            if not events & EVENT_SPAWN:
+                course.fill()
+            self.ini_time += 1
+            if self.profiler is not None:
+                self.profiler.lap(PHASE_UPDATE)
+            objects = self.lvl_objects
+            # Expire poles far behind the ball
+            while objects and ball.x - objects[0].x > W_WIDTH:
+                objects.popleft()
+                if self._passed:
+                    self._passed -= 1
+            # Skip poles the ball has passed; stop at the first one out of reach ahead
+            left = ball.x + ball.width/2 - ball.radius
+            right = left + 2 * ball.radius
+            i = self._passed
+            while i < len(objects) and objects[i].x + objects[i].width < left:
+                i += 1
+            self._passed = i
+            while i < len(objects) and objects[i].x <= right:
+                o = objects[i]
+                i += 1
+                if o.kind == KIND_POLE:
+                    if self.collideball(o):
+                        self.state = STATE_GAMEOVER
+                        events |= EVENT_FAIL
+                elif o.kind == KIND_SCORE:
+                    if o.active and self.collideball(o):
+                        self.score += 1
+                        o.active = False
+                        events |= EVENT_SCORE
+            if self._hit_ground():
+                self.state = STATE_GAMEOVER
+                events |= EVENT_FAIL
+            if self.profiler is not None:
+                self.profiler.lap(PHASE_COLLISION)
+        return events
+
+    def run(self, frames, policy=None):
+        # Headless rollout; policy(sim) returns True to flap before a frame
+        if self.state == STATE_INTRO:
+            self.start()
+        for i in range(frames):
+            if self.state != STATE_RUN:
+                break
+            if policy is not None and policy(self):
+                self.flap()
+            self.step()
+        return self.score
+
+
+def _crowd(sim, count):
+    # About count pole objects spawned spacing apart from half a screen behind
+    # the ball, which is held in place with nothing more to spawn
+    ball = sim.ball
+    ball.velo = ball.accel = 0
+    # The course starts out of reach, so nothing spawns
+    sim.course.restart(float('inf'))
+    spacing = sim.course.spacing
+    for i in range(max(count // 3, 1)):
+        sim.add_poles(ball.x - W_WIDTH/2 + i * spacing, ball.y - ball.height, 3 * ball.height)
+
+
+def benchmark_broadphase(counts=(30, 300, 3000, 30000), frames=100):
+    # Per-frame cost of Simulation.step() with count pole objects live, next to
+    # a scan testing every object each frame (what update() used to do)
+    results = []
+    for count in counts:
+        sim = Simulation()
+        sim.start()
+        _crowd(sim, count)
+        count = len(sim.lvl_objects)
+        start = time.perf_counter()
+        for i in range(frames):
+            for o in sim.lvl_objects:
+                sim.collideball(o)
+        scan_time = (time.perf_counter() - start) / frames
+        sim.step()
+        start = time.perf_counter()
+        for i in range(frames):
+            sim.step()
+        step_time = (time.perf_counter() - start) / frames
+        results.append({'objects': count, 'step_us': step_time * 1e6, 'full_scan_us': scan_time * 1e6})
+    return results
+
+
+def _hline_mask(width, height, x0, x1, y):
+    # (width, height) mask of horizontal lines from x0 to x1 inclusive, clipped
+    # like gfxdraw.hline; one cumulative sum instead of a call per line
+    diff = np.zeros((height, width + 1), np.int32)
+    np.add.at(diff, (y, np.clip(x0, 0, width)), 1)
+    np.add.at(diff, (y, np.clip(x1 + 1, 0, width)), -1)
+    return (np.cumsum(diff, axis=1)[:, :width] > 0).T
+
+
+def collide_circle_rects(cx, cy, r, rx, ry, rw, rh):
+    # Array form of Simulation.collideball; arguments broadcast, so one call
+    # tests a ball against every rect (or every lane against its rects)
+    dx = np.maximum(np.maximum(rx - cx, cx - (rx + rw)), 0)
+    dy = np.maximum(np.maximum(ry - cy, cy - (ry + rh)), 0)
+    return dx * dx + dy * dy <= r * r
+
+
+class BatchSimulation():
+    # n independent games with the rules of Simulation, stored as one array per
+    # field so every lane advances in the same few NumPy operations.
+    # Each lane draws its poles from its own seeded generator (lane i of seed s
+    # always sees the same course), pre-drawn rng_block spawns at a time.
+    def __init__(self, n, seed=None, fps=60, rng_block=64):
+        self.n = n
+        self.FPS = fps
+        self.rng_block = rng_block
+        _layout = layout(W_WIDTH, W_HEIGHT)
+        self.radius = _layout.ball_radius
+        self.ball_size = self.radius * 2
+        self.ball_start = _layout.ball_start
+        self.gap_sizes = np.array(_layout.gap_sizes)
+        self.gap_starts = np.array(_layout.gap_starts)
+        self.pole_width = _layout.pole_width
+        # Poles live from spawn (W_WIDTH/2 ahead) until W_WIDTH behind the ball
+        _lifetime = (self.ball_size + 3 * W_WIDTH/2) / SPEED
+        self.capacity = int(math.ceil(_lifetime / (int(3 * fps/2) + 1))) + 2
+        # Poles spaced wider than a pole plus the ball: only the nearest one can touch it
+        self._single_pole = SPEED * (int(3 * fps/2) + 1) > self.pole_width + self.ball_size
+        self.state = np.full(n, STATE_RUN, np.int8)
+        self.score = np.zeros(n, np.int64)
+        self.x = np.zeros(n, np.int64)
+        self.y = np.zeros(n, np.int64)
+        self.velo = np.zeros(n)
+        self.ini_time = np.zeros(n, np.int64)
+        self.time_passed = np.zeros(n, np.int64)
+        # One row per lane, one column per pole pair (ring buffer of capacity slots)
+        shape = (n, self.capacity)
+        self.pole_x = np.zeros(shape, np.int64)
+        self.score_x = np.zeros(shape, np.int64)
+        self.gap_y = np.zeros(shape, np.int64)
+        self.gap_h = np.zeros(shape, np.int64)
+        self.pole_live = np.zeros(shape, bool)
+        self.pole_scored = np.zeros(shape, bool)
+        self.pole_head = np.zeros(n, np.int64)
+        self._draws = np.zeros((n, rng_block, 2), np.int64)
+        self._cursor = np.full(n, rng_block)
+        self._rngs = [None] * n
+        self.seed(np.arange(n), seed)
+        self.reset()
+
+    def seed(self, lanes, seed=None):
+        # Lane i gets child i of SeedSequence(seed), independent of n
+        children = np.random.SeedSequence(seed).spawn(self.n)
+        for i in lanes:
+            self._rngs[i] = np.random.default_rng(children[i])
+        self._cursor[lanes] = self.rng_block
+
+    def reset(self, mask=None, seed=None):
+        lanes = np.arange(self.n) if mask is None else np.flatnonzero(mask)
+        if seed is not None:
+            self.seed(lanes, seed)
+        self.state[lanes] = STATE_RUN
+        self.score[lanes] = 0
+        self.x[lanes] = self.ball_start[0]
+        self.y[lanes] = self.ball_start[1]
+        self.velo[lanes] = 1
+        self.ini_time[lanes] = 0
+        self.time_passed[lanes] = 0
+        self.pole_live[lanes] = False
+        self.pole_scored[lanes] = False
+        self.pole_head[lanes] = 0
+
+    def _spawn(self, lanes):
+        for i in lanes[self._cursor[lanes] >= self.rng_block]:
+            self._draws[i, :, 0] = self._rngs[i].integers(0, len(self.gap_sizes), self.rng_block)
+            self._draws[i, :, 1] = self._rngs[i].integers(0, len(self.gap_starts), self.rng_block)
+            self._cursor[i] = 0
+        draw = self._draws[lanes, self._cursor[lanes]]
+        self._cursor[lanes] += 1
+        slot = self.pole_head[lanes]
+        self.pole_head[lanes] = (slot + 1) % self.capacity
+        pos = self.x[lanes] + self.ball_size + W_WIDTH/2
+        self.pole_x[lanes, slot] = pos.astype(np.int64)
+        self.score_x[lanes, slot] = (pos + self.pole_width/4).astype(np.int64)
+        self.gap_h[lanes, slot] = self.gap_sizes[draw[:, 0]]
+        self.gap_y[lanes, slot] = self.gap_starts[draw[:, 1]]
+        self.pole_live[lanes, slot] = True
+        self.pole_scored[lanes, slot] = False
+
+    def next_gap(self):
+        # Gap (y, height) of the nearest pole the ball has not passed; -1 if none
+        ahead = self.pole_live & (self.pole_x + self.pole_width > self.x[:, None])
+        j = np.argmin(np.where(ahead, self.pole_x, np.iinfo(np.int64).max), axis=1)
+        rows = np.arange(self.n)
+        found = ahead[rows, j]
+        return np.where(found, self.gap_y[rows, j], -1), np.where(found, self.gap_h[rows, j], -1)
+
+    def step(self, flap=None):
+        events = np.zeros(self.n, np.int8)
+        run = self.state == STATE_RUN
+        if flap is not None:
+            self.velo[run & flap] = -GRAVITY * 10
+        self.velo[run] += GRAVITY
+        self.x[run] += SPEED
+        y = self.y + self.velo
+        y = np.where(y >= 0, np.floor(y + .5), -np.floor(-y + .5)).astype(np.int64)
+        self.y = np.where(run, np.maximum(y, -int(self.ball_size/2)), self.y)
+        # Determine when the poles are made
+        timed = run & (self.ini_time > int(self.FPS))
+        spawn = timed & (self.time_passed > int(3 * self.FPS/2))
+        if spawn.any():
+            self._spawn(np.flatnonzero(spawn))
+            self.time_passed[spawn] = 0
+            events[spawn] |= EVENT_SPAWN
+        self.time_passed[timed] += 1
+        self.ini_time[run] += 1
+        # Collision against the poles the ball has not fully passed
+        pw = int(self.pole_width)
+        candidates = self.pole_live & (self.pole_x + pw >= self.x[:, None])
+        rows = np.arange(self.n)[:, None]
+        if self._single_pole:
+            cols = np.argmin(np.where(candidates, self.pole_x, np.iinfo(np.int64).max), axis=1)[:, None]
+        else:
+            cols = np.arange(self.capacity)[None, :]
+        live = candidates[rows, cols] & run[:, None]
+        self.pole_live &= ~(self.x[:, None] - self.pole_x > W_WIDTH)
+        pole_x, score_x = self.pole_x[rows, cols], self.score_x[rows, cols]
+        gap_y, gap_h = self.gap_y[rows, cols], self.gap_h[rows, cols]
+        cx = (self.x + self.ball_size/2)[:, None]
+        cy = (self.y + self.ball_size/2)[:, None]
+        bottom_y = gap_y + gap_h
+        fail = (live & (collide_circle_rects(cx, cy, self.radius, pole_x, 0, pw, gap_y) |
+                        collide_circle_rects(cx, cy, self.radius, pole_x, bottom_y, pw, W_HEIGHT - bottom_y))).any(1)
+        scoring = live & ~self.pole_scored[rows, cols] & ~(self.x[:, None] - score_x > W_WIDTH) & \
+            collide_circle_rects(cx, cy, self.radius, score_x, gap_y, int(pw/2), gap_h)
+        self.pole_scored[rows, cols] |= scoring
+        scored = scoring.sum(1)
+        self.score += scored
+        events[scored > 0] |= EVENT_SCORE
+        fail |= run & (W_HEIGHT - 1 < self.y + self.ball_size) & (self.y < W_HEIGHT)
+        self.state[fail] = STATE_GAMEOVER
+        events[fail] |= EVENT_FAIL
+        return events
+
+
+def benchmark_batch(n=4096, frames=600, seed=0):
+    # Lane-frames per second of BatchSimulation against a loop of Simulation
+    # objects, both flapping to hold the ball mid-screen and restarting on death
+    batch = BatchSimulation(n, seed=seed)
+    start = time.perf_counter()
+    for i in range(frames):
+        batch.step((batch.y > W_HEIGHT/2) & (batch.velo > 0))
+        batch.reset(batch.state != STATE_RUN)
+    batch_rate = n * frames / (time.perf_counter() - start)
+    sims = [Simulation(rng=random.Random(seed + i)) for i in range(min(n, 64))]
+    for sim in sims:
+        sim.start()
+    start = time.perf_counter()
+    for i in range(frames):
+        for sim in sims:
+            if sim.ball.y > W_HEIGHT/2 and sim.ball.velo > 0:
+                sim.flap()
+            sim.step()
+            if sim.state != STATE_RUN:
+                sim.reset()
+                sim.state = STATE_RUN
+    scalar_rate = len(sims) * frames / (time.perf_counter() - start)
+    return {'lanes': n, 'frames': frames, 'batch_fps': batch_rate, 'scalar_fps': scalar_rate,
+            'speedup': batch_rate / scalar_rate}
+
+
+def gap_policy(y, velo, gap_y, gap_h):
+    # Example bot: flap when the ball sinks past the middle of the next gap
+    if velo <= 0:
+        return False
+    middle = gap_y + gap_h/2 if gap_y >= 0 else W_HEIGHT/2
+    return y + layout(W_WIDTH, W_HEIGHT).ball_radius > middle
+
+
+def _tournament_init(speed, gravity):
+    # Difficulty constants for this worker only
+    global SPEED, GRAVITY
+    SPEED = speed
+    GRAVITY = gravity
+
+
+def _episode(job):
+    policy, seed, max_frames, gap_sizes, gap_starts = job
+    # The same course as Main(seed=seed), so any episode can be watched
+    sim = Simulation(rng=random.Random(seed))
+    if gap_sizes is not None:
+        sim.gap_sizes = list(gap_sizes)
+    if gap_starts is not None:
+        sim.gap_starts = list(gap_starts)
+    sim.run(max_frames, lambda s: policy(s.ball.y, s.ball.velo, *s.next_gap()))
+    return sim.score, sim.ini_time
+
+
+def tournament(policy=gap_policy, episodes=1000, seed=0, processes=None, max_frames=36000,
+               speed=SPEED, gravity=GRAVITY, gap_sizes=None, gap_starts=None):
+    # Scores of policy(y, velo, gap_y, gap_h) -> flap? over episodes seeded
+    # seed, seed + 1, ... spread over a process pool. policy must be picklable
+    # (a module-level function). Episodes end at max_frames if never lost.
+    import multiprocessing
+    processes = processes or multiprocessing.cpu_count()
+    jobs = [(policy, seed + i, max_frames, gap_sizes, gap_starts) for i in range(episodes)]
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes, _tournament_init, (speed, gravity)) as pool:
+        results = pool.map(_episode, jobs, chunksize=max(1, episodes // (processes * 8)))
+    elapsed = time.perf_counter() - start
+    scores = np.array([r[0] for r in results])
+    frames = np.array([r[1] for r in results])
+    p10, p50, p90, p99 = np.percentile(scores, [10, 50, 90, 99]).tolist()
+    return {'episodes': episodes, 'processes': processes, 'seconds': elapsed,
+            'episodes_per_s': episodes / elapsed, 'frames_per_s': frames.sum() / elapsed,
+            'mean': scores.mean(), 'std': scores.std(), 'min': int(scores.min()), 'max': int(scores.max()),
+            'p10': p10, 'p50': p50, 'p90': p90, 'p99': p99, 'capped': int((frames >= max_frames).sum()),
+            'histogram': np.bincount(scores).tolist(), 'scores': scores}
+
+
+class FrameProfiler():
+    # Per-phase timings of the last capacity - 1 frames in a ring buffer.
+    # lap(phase) charges the time since the previous lap to that phase.
+    def __init__(self, fps=60, capacity=3601):
+        self.budget = 1000.0 / fps
+        self.times = np.zeros((capacity, len(PHASES)))
+        self.frames = 0
+        self.start()
+
+    def start(self):
+        # Laps count from now; call it just before the first frame so setup
+        # isn't charged to that frame's first phase
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.times[self.frames % len(self.times), phase] += (now - self._last) * 1000
+        self._last = now
+
+    def end_frame(self):
+        self.frames += 1
+        self.times[self.frames % len(self.times)] = 0
+
+    def recorded(self):
+        # Completed frames still in the buffer, oldest first, in ms
+        count = min(self.frames, len(self.times) - 1)
+        return self.times[np.arange(self.frames - count, self.frames) % len(self.times)]
+
+    def stats(self):
+        times = self.recorded()
+        total = times.sum(1)
+        def percentiles(values):
+            if not len(values):
+                return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+            return dict(zip(('p50', 'p95', 'p99'), np.percentile(values, [50, 95, 99]).tolist()))
+        # A frame whose work alone overruns the budget missed its slot
+        dropped = int((total - times[:, PHASE_SLEEP] > self.budget).sum())
+        return {'frames': len(times), 'dropped': dropped, 'budget_ms': self.budget, 'frame_ms': percentiles(total),
+                'phases_ms': dict((name, percentiles(times[:, i])) for i, name in enumerate(PHASES))}
+
+    def export(self, path):
+        # Per-frame rows for .csv, the summary for anything else (JSON)
+        if path.endswith('.csv'):
+            with open(path, 'w') as f:
+                f.write(','.join(PHASES + ('total',)) + '\n')
+                for row in self.recorded():
+                    f.write(','.join('%.4f' % v for v in row.tolist() + [row.sum()]) + '\n')
+        else:
+            import json
+            with open(path, 'w') as f:
+                json.dump(self.stats(), f, indent=2)
+
+
+class FixedStep():
+    # Accumulates real time and pays it out in fixed simulation ticks, so the
+    # game runs at fps whatever the render rate. At most max_steps ticks are
+    # run per rendered frame; time owed beyond that is dropped (counted in
+    # dropped) instead of piling up while rendering can't keep up.
+    def __init__(self, fps=60, max_steps=5):
+        self.dt = 1.0 / fps
+        self.max_steps = max_steps
+        self.acc = 0.0
+        self.last = None
+        self.ticks = 0
+        self.dropped = 0
+
+    def advance(self, now=None):
+        # Ticks to run before rendering the frame at now
+        if now is None:
+            now = time.perf_counter()
+        if self.last is None:
+            self.last = now - self.dt
+        self.acc += now - self.last
+        self.last = now
+        steps = int(self.acc / self.dt)
+        if steps > self.max_steps:
+            self.dropped += steps - self.max_steps
+            steps = self.max_steps
+            self.acc = self.dt * steps
+        self.acc -= self.dt * steps
+        self.ticks += steps
+        return steps
+
+    def alpha(self):
+        # How far the render time is between the last tick and the next
+        return min(self.acc / self.dt, 1.0)
+
+
+def benchmark_timestep(render_ms=(0, 10, 25, 50, 100), seconds=1.0, fps=60):
+    # Simulation speed while each rendered frame is throttled to render_ms,
+    # with the fixed-timestep loop and with one tick per frame (the old loop)
+    results = []
+    for ms in render_ms:
+        row = {'render_ms': ms}
+        for name in ('fixed', 'coupled'):
+            sim = Simulation(rng=random.Random(0), fps=fps)
+            sim.start()
+            clock = FixedStep(fps)
+            frames = ticks = 0
+            start = time.perf_counter()
+            end = start + seconds
+            while time.perf_counter() < end:
+                steps = clock.advance() if name == 'fixed' else 1
+                for i in range(steps):
+                    if sim.state != STATE_RUN:
+                        sim.restart()
+                    sim.step()
+                ticks += steps
+                frames += 1
+                # Rendering, or the frame limiter when it is quicker than a tick
+                time.sleep(max(ms / 1000.0, 0 if name == 'fixed' else 1.0 / fps))
+            elapsed = time.perf_counter() - start
+            row[name + '_ticks_per_s'] = ticks / elapsed
+            if name == 'fixed':
+                # Up to the last frame, counting the part-tick still owed
+                row[name + '_ticks_per_s'] = (ticks + clock.alpha()) / (clock.last - start + clock.dt)
+                row['render_fps'] = frames / elapsed
+                row['dropped_ticks'] = clock.dropped
+        results.append(row)
+    return results
+
+
+class Replay():
+    # Seed, starting timecycle and frame-stamped taps/restarts of a session.
+    # Simulation only draws from its own seeded rng, so applying the actions
+    # at the same frames reproduces the run exactly, rendered or headless.
+    MAGIC = b'BBBR'
+    VERSION = 1
+    # magic, version, seed, timecycle, fps, frames, final score, action count
+    HEADER = struct.Struct('<4sBQBHIII')
+
+    def __init__(self, seed, timecycle=0, fps=60):
+        # The header stores the seed unsigned in 64 bits
+        if not 0 <= seed < 2 ** 64:
+            raise ValueError('seed must be in 0..2**64-1, got %d' % seed)
+        self.seed = seed
+        self.timecycle = timecycle
+        self.fps = fps
+        self.frames = 0
+        self.score = 0
+        self.actions = []
+
+    def record(self, frame, action):
+        self.actions.append((frame, action))
+
+    def save(self, path):
+        data = bytearray(self.HEADER.pack(self.MAGIC, self.VERSION, self.seed, self.timecycle, self.fps,
+                                          self.frames, self.score, len(self.actions)))
+        last = 0
+        for frame, action in self.actions:
+            # Frame delta and action packed into one varint
+            value = (frame - last) << 1 | action
+            last = frame
+            while value >= 0x80:
+                data.append(value & 0x7f | 0x80)
+                value >>= 7
+            data.append(value)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < cls.HEADER.size:
+            raise ValueError('%s is not a replay file' % path)
+        magic, version, seed, timecycle, fps, frames, score, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('%s is not a replay file' % path)
+        replay = cls(seed, timecycle, fps)
+        replay.frames = frames
+        replay.score = score
+        pos = cls.HEADER.size
+        frame = 0
+        for i in range(count):
+            value = shift = 0
+            while True:
+                if pos >= len(data):
+                    raise ValueError('%s is not a replay file' % path)
+                byte = data[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            frame += value >> 1
+            replay.actions.append((frame, value & 1))
+        return replay
+
+    def play(self):
+        # Headless fast-forward through the recorded frames
+        sim = Simulation(rng=random.Random(self.seed), fps=self.fps)
+        actions = self.actions
+        i = 0
+        for frame in range(self.frames):
+            while i < len(actions) and actions[i][0] <= frame:
+                if actions[i][1] == ACTION_TAP:
+                    sim.tap()
+                else:
+                    sim.restart()
+                i += 1
+            sim.step()
+        return sim
+
+    def verify(self):
+        return self.play().score == self.score
+
+
+class SoundBank():
+    # Sound effects synthesized with NumPy once per mixer format, played from a
+    # worker thread so play() never waits on the mixer. A sound triggered again
+    # within min_interval seconds is skipped. Silent if there is no audio device.
+    # name: (start Hz, end Hz, seconds, decay seconds, harmonics)
+    TONES = {'bounce': (330, 660, .12, .04, 1),
+             'fail': (440, 110, .5, .2, 3)}
+    _cache = {}
+
+    def __init__(self, min_interval=.05, volume=.3):
+        self.min_interval = min_interval
+        self.volume = volume
+        self.skipped = 0
+        self._last = {}
+        self.sounds = {}
+        try:
+            pygame.mixer.init()
+        except pygame.error:
+            self.enabled = False
+            return
+        self.enabled = True
+        for name in self.TONES:
+            self.sounds[name] = pygame.sndarray.make_sound(self._samples(name, pygame.mixer.get_init()))
+        self._queue = queue.Queue(16)
+        self._thread = threading.Thread(target=self._run, name='SoundBank')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _samples(self, name, mixer):
+        key = (name, self.volume) + mixer
+        if key not in self._cache:
+            self._cache[key] = self._synthesize(self.TONES[name], mixer)
+        return self._cache[key]
+
+    def _synthesize(self, tone, mixer):
+        # Frequency sweep (phase is the integral of the frequency), odd
+        # harmonics for a harsher tone, 5ms attack and exponential decay
+        start, end, seconds, decay, harmonics = tone
+        frequency, size, channels = mixer
+        t = np.arange(int(frequency * seconds)) / float(frequency)
+        phase = 2 * np.pi * (start * t + (end - start) * t * t / (2 * seconds))
+        k = np.arange(1, 2 * harmonics, 2)[:, None]
+        wave = (np.sin(k * phase) / k).sum(0)
+        wave *= np.minimum(t / .005, 1) * np.exp(-t / decay) * self.volume / np.abs(wave).max()
+        # To the mixer's sample format, one column per channel
+        bits = abs(size)
+        if bits == 32:
+            pcm = wave.astype(np.float32)
+        else:
+            peak = 2 ** (bits - 1) - 1
+            pcm = (wave * peak).astype(np.int8 if bits == 8 else np.int16)
+            if size > 0:
+                pcm = (pcm.astype(np.int32) + peak + 1).astype(np.uint8 if bits == 8 else np.uint16)
+        return np.ascontiguousarray(np.repeat(pcm[:, None], channels, 1)) if channels > 1 else pcm
+
+    def play(self, name, now=None):
+        if now is None:
+            now = time.perf_counter()
+        if now - self._last.get(name, -self.min_interval) < self.min_interval:
+            self.skipped += 1
+            return False
+        self._last[name] = now
+        if not self.enabled:
+            return False
+        try:
+            self._queue.put_nowait(name)
+        except queue.Full:
+            self.skipped += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            if name is None:
+                break
+            self.sounds[name].play()
+
+    def close(self):
+        if self.enabled:
+            self._queue.put(None)
+            self._thread.join(1)
+            self.enabled = False
+
+
+class Main():
+    def __init__(self, dirty_rects=False, seed=None, record=None, replay=None, profile=None, asset_cache=None,
+                 max_fps=60, resolution=None, fullscreen=False):
         pygame.display.set_caption('Bouncing Beach Ball')
         self.FPS = 60
+        # Physics ticks at FPS; frames are rendered at up to max_fps (0: no limit)
+        self.max_fps = max_fps
+        self.clock = FixedStep(self.FPS)
+        self._prev = None
+        if replay is not None:
+            seed = replay.seed
+        elif seed is None:
+            seed = random.randrange(2 ** 32)
+        # Separate stream: the moon phase never shifts the pole sequence
+        self.rng = random.Random(seed + 1)
+        # Redraw and present only the changed regions instead of the whole window
+        self.dirty_rects = dirty_rects
+        self._view = None
+        self._drawn = []
+        self._drawn_cam = None
         self.fpsClock = pygame.time.Clock()
-        self.score = 0
+        self.sim = Simulation(rng=random.Random(seed), fps=self.FPS)
+        # Sprites for upcoming poles are made while they wait in the course buffer
+        self.sim.course.prefetch = self._prefetch_poles
+        # Frame timings, exported on quit when a profile path is given; F3 shows them
+        self.profiler = FrameProfiler(max_fps or self.FPS)
+        self.sim.profiler = self.profiler
+        self.profile_path = profile
+        self.show_profiler = False
+        self._profiler_img = None
+        self._profiler_at = 0
         hour = time.localtime()[3]
-        if 6 <= hour <= 9:
+        if replay is not None:
+            self.timecycle = replay.timecycle
+        elif 6 <= hour <= 9:
             self.timecycle = 0
         elif 10 <= hour <= 16:
             self.timecycle = 1
@@ -85,84 +1059,185 @@ class Main():
             self.timecycle = 2
         else:
             self.timecycle = 3
-        self.moonphase = random.randint(0, 15) % 8
+        # Actions are only kept when there is a record path to save them to on quit
+        self.frame = 0
+        self.replay = Replay(seed, self.timecycle, self.FPS) if record else None
+        self.record_path = record
+        self.playback = replay
+        self._playback_pos = 0
+        self.moonphase = self.rng.randint(0, 15) % 8
         self.moon_offsets = [-20, -3, -2, -1, 0, 1, 2, 3]
-        self.canvas = pygame.display.set_mode((W_WIDTH, W_HEIGHT), 0, 32)
+        self._create_display(resolution, fullscreen)
         self.bg_objects = []
-        self.lvl_objects = []
+        # Built scenes by (timecycle, moonphase), optionally also kept as PNGs in asset_cache
+        self.scenes = {}
+        self.asset_cache = asset_cache
+        self.ball_img = None
+        self.pole_images = {}
         self.txt = []
         self._create_bg()
-        self.font = pygame.font.SysFont('miriam', 48)
+        self._create_pole_images()
+        self.font = pygame.font.SysFont('miriam', self._px(48))
+        self.small_font = pygame.font.SysFont('monospace', 14)
+        self.text_images = {}
+        self._score_key = None
         self._create_txt()
-        self.ini_time = 0
-        self.time_passed = 0
         self.bg_cam = [0, 0]
+        self._prev_cam = 0
         self.lvl_cam = [0, 0]
         self.ui_cam = [0, 0]
         self.create_sounds()
 
+    def _create_display(self, resolution, fullscreen):
+        # Fullscreen without a resolution has SDL scale W_WIDTH x W_HEIGHT frames
+        # in hardware. Otherwise frames are drawn at the window size from
+        # pre-scaled assets, letterboxed to keep the playfield's shape.
+        flags = FULLSCREEN if fullscreen else 0
+        if fullscreen and resolution is None:
+            try:
+                display = pygame.display.set_mode((W_WIDTH, W_HEIGHT), flags | SCALED, 32)
+            except pygame.error:
+                # No renderer to scale with: draw at the desktop size instead
+                display = pygame.display.set_mode((0, 0), flags, 32)
+        else:
+            display = pygame.display.set_mode(resolution or (W_WIDTH, W_HEIGHT), flags, 32)
+        width, height = display.get_size()
+        self.scale = min(float(width) / W_WIDTH, float(height) / W_HEIGHT)
+        self.view_rect = Rect(0, 0, self._px(W_WIDTH), self._px(W_HEIGHT))
+        self.view_rect.center = display.get_rect().center
+        display.fill(BLACK)
+        if self.view_rect.size == display.get_size():
+            self.canvas = display
+        else:
+            self.canvas = display.subsurface(self.view_rect)
+        # Screen positions for the text and overlays
+        self.view = layout(*self.view_rect.size)
+
+    def _px(self, value):
+        # Playfield units to screen pixels
+        return _round(value * self.scale)
+
     def _create_bg(self):
-        bg_total_img = pygame.Surface([W_WIDTH * 2, W_HEIGHT], pygame.SRCALPHA, 32)
+        # Night scenes differ by moon phase; the others share one scene per timecycle
+        key = (self.timecycle, self.moonphase if self.timecycle == 3 else 0)
+        scene = self.scenes.get(key)
+        if scene is None:
+            scene = self._load_scene(key)
+            if scene is None:
+                bg_img, sun_img, _reflect_img = self._build_scene(*key)
+                # The background is opaque: in the display format it is the cheapest full-screen blit
+                scene = self._prescale(bg_img.convert(), sun_img, _reflect_img)
+            if self.asset_cache:
+                self._save_scene(key, scene)
+            bg_img = scene[0]
+            # Only rows that vary along x change when the background scrolls
+            _pixels = pygame.surfarray.pixels2d(bg_img)
+            _rows = np.flatnonzero((_pixels[1:] != _pixels[:-1]).any(axis=0))
+            del _pixels
+            bg_strip = Rect(0, 0, 0, 0)
+            if len(_rows):
+                bg_strip = Rect(0, _rows[0], bg_img.get_width(), _rows[-1] - _rows[0] + 1)
+            scene = self.scenes[key] = (bg_img, bg_strip) + scene[1:]
+        self.bg, self.bg_strip, sun_img, _reflect_img = scene
+        _layout = self.sim.layout
+        _sun_pos = (self._px(_layout.sun_pos[0]), self._px(_layout.sun_pos[1]))
+        self.bg_objects.append(Entity(KIND_SCENERY, _sun_pos[0], _sun_pos[1], *sun_img.get_size(), image=sun_img))
+        _reflect_pos = (self._px(_layout.reflect_pos[0]), self._px(_layout.reflect_pos[1]))
+        self.bg_objects.append(Entity(KIND_SCENERY, _reflect_pos[0], _reflect_pos[1], *_reflect_img.get_size(),
+                                      image=_reflect_img))
+
+    def _prescale(self, *images):
+        # Images drawn at playfield size, scaled once to the screen
+        if self.scale == 1:
+            return images
+        return tuple(pygame.transform.smoothscale(img, (self._px(img.get_width()), self._px(img.get_height())))
+                     for img in images)
+
+    def _scene_paths(self, key):
+        import os
+        name = 'scene-%dx%d-%d-%d-%%s.png' % (self.canvas.get_size() + key)
+        return [os.path.join(self.asset_cache, name % part) for part in ('bg', 'sun', 'reflect')]
+
+    def _load_scene(self, key):
+        import os
+        if not self.asset_cache:
+            return None
+        paths = self._scene_paths(key)
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        bg_img, sun_img, _reflect_img = [pygame.image.load(path) for path in paths]
+        return bg_img.convert(), sun_img.convert_alpha(), _reflect_img.convert_alpha()
+
+    def _save_scene(self, key, scene):
+        import os
+        paths = self._scene_paths(key)
+        if all(os.path.exists(path) for path in paths):
+            return
+        if not os.path.isdir(self.asset_cache):
+            os.makedirs(self.asset_cache)
+        for path, img in zip(paths, scene):
+            pygame.image.save(img, path)
+
+    def _build_scene(self, timecycle, moonphase):
+        # Scenery depends only on the timecycle and moon phase (its rng is seeded
+        # from them), so a built scene can be cached in memory and on disk
+        rng = np.random.default_rng([timecycle, moonphase])
+        _layout = self.sim.layout
         bg_img = pygame.Surface([W_WIDTH, W_HEIGHT], pygame.SRCALPHA, 32)
         bg_img = bg_img.convert_alpha()
-        rect_horizon = Rect(0, int(7 * W_HEIGHT/24), W_WIDTH, W_HEIGHT - int(7 * W_HEIGHT/24))
-        rect_ocean = Rect(0, int(W_HEIGHT/3), W_WIDTH, W_HEIGHT - int(W_HEIGHT/3))
-        rect_sand = Rect(0, int(7 * W_HEIGHT/12), W_WIDTH, W_HEIGHT - int(7 * W_HEIGHT/12))
-        bg_img.fill(COLORS_SKY[self.timecycle])
+        rect_horizon = Rect(0, _layout.horizon_y, W_WIDTH, W_HEIGHT - _layout.horizon_y)
+        rect_ocean = Rect(0, _layout.ocean_y, W_WIDTH, W_HEIGHT - _layout.ocean_y)
+        rect_sand = Rect(0, _layout.sand_y, W_WIDTH, W_HEIGHT - _layout.sand_y)
+        bg_img.fill(COLORS_SKY[timecycle])
         # Horizon
-        bg_img.fill(COLORS_HORIZON[self.timecycle], rect_horizon)
-        bg_img.fill(COLORS_OCEAN[self.timecycle], rect_ocean)
-        bg_img.fill(COLORS_SAND[self.timecycle], rect_sand)
-        # Sand particles
-        for i in range(2048):
-            x_range = random.randint(0, W_WIDTH)
-            y_range = random.randint(int(7 * W_HEIGHT/12), W_HEIGHT)
-            pygame.gfxdraw.pixel(bg_img, x_range, y_range, COLORS_SANDPARTICLES[self.timecycle])
+        bg_img.fill(COLORS_HORIZON[timecycle], rect_horizon)
+        bg_img.fill(COLORS_OCEAN[timecycle], rect_ocean)
+        bg_img.fill(COLORS_SAND[timecycle], rect_sand)
+        _pixels = pygame.surfarray.pixels2d(bg_img)
+        # Sand particles (the upper bounds are inclusive, as with randint; off-surface ones are dropped)
+        x_range = rng.integers(0, W_WIDTH + 1, 2048)
+        y_range = rng.integers(_layout.sand_y, W_HEIGHT + 1, 2048)
+        _on = (x_range < W_WIDTH) & (y_range < W_HEIGHT)
+        # map_rgb comes back signed; the pixel array is unsigned
+        _pixels[x_range[_on], y_range[_on]] = bg_img.map_rgb(COLORS_SANDPARTICLES[timecycle]) & 0xffffffff
         # Waves in ocean (4/12 to 7/12 exclusive) or (17/24 to 27/48)
-        for i in range(128):
-            x_range = random.randint(0, W_WIDTH - int(W_WIDTH/32))
-            y_range = random.randint(int(17 * W_HEIGHT/48), int(27 * W_HEIGHT/48))
-            pygame.gfxdraw.hline(bg_img, x_range, int(x_range + W_WIDTH/4), y_range, COLORS_OCEAN_WAVES[self.timecycle])
-            if int(x_range + W_WIDTH/4 >= W_WIDTH):
-                pygame.gfxdraw.hline(bg_img, 0, int(W_WIDTH/8), y_range, COLORS_OCEAN_WAVES[self.timecycle])
+        x_range = rng.integers(0, W_WIDTH - _layout.wave_margin + 1, 128)
+        y_range = rng.integers(_layout.wave_rows[0], _layout.wave_rows[1] + 1, 128)
+        _wrap = x_range + _layout.wave_length >= W_WIDTH
+        _waves = _hline_mask(W_WIDTH, W_HEIGHT,
+                             np.concatenate([x_range, np.zeros(_wrap.sum(), int)]),
+                             np.concatenate([x_range + _layout.wave_length, np.full(_wrap.sum(), _layout.wave_wrap)]),
+                             np.concatenate([y_range, y_range[_wrap]]))
+        _pixels[_waves] = bg_img.map_rgb(COLORS_OCEAN_WAVES[timecycle]) & 0xffffffff
+        del _pixels
         # "Wave crashes"
-        _wave_crash = pygame.Surface([W_WIDTH, int(W_HEIGHT/16)], pygame.SRCALPHA, 32)
+        _wave_crash = pygame.Surface([W_WIDTH, _layout.wave_crash_height], pygame.SRCALPHA, 32)
         _wave_crash = _wave_crash.convert_alpha()
         _w_rect = _wave_crash.get_rect()
         pygame.gfxdraw.filled_ellipse(_wave_crash, int(_w_rect.width/4),0,
-                                      int(_w_rect.width/4), int(_w_rect.height), COLORS_WAVE_CRASH[self.timecycle])
+                                      int(_w_rect.width/4), int(_w_rect.height), COLORS_WAVE_CRASH[timecycle])
         pygame.gfxdraw.filled_ellipse(_wave_crash, int(3*_w_rect.width/4),0,
-                                      int(_w_rect.width/4), int(_w_rect.height), COLORS_WAVE_CRASH[self.timecycle])
+                                      int(_w_rect.width/4), int(_w_rect.height), COLORS_WAVE_CRASH[timecycle])
         # Finalizing the background
-        bg_img.blit(_wave_crash, (0, int(7 * W_HEIGHT/12)), None, BLEND_MAX)
-        bg_total_img.blit(bg_img, (0,0))
-        bg_total_img.blit(bg_img, (W_WIDTH, 0))
-        self.bg = bg_total_img
-        # Ground
-        gnd_img = pygame.Surface([W_WIDTH, 1], pygame.SRCALPHA, 32)
-        gnd_img = gnd_img.convert_alpha()
-        self.bg_objects.append({'name': 'ground', 'image': gnd_img,
-                                'rect': Rect(0, W_HEIGHT - 1, W_WIDTH, 1), 'active': True})
+        bg_img.blit(_wave_crash, (0, _layout.sand_y), None, BLEND_MAX)
         # Sun/Moon
-        _r = int(W_WIDTH/8) if W_WIDTH < W_HEIGHT else int(W_HEIGHT/16)
+        _r = _layout.sun_radius
         _d = _r * 2
         sun_img = pygame.Surface([_d, _d], pygame.SRCALPHA, 32)
         sun_img = sun_img.convert_alpha()
         _orig = (int(sun_img.get_width()/2), int(sun_img.get_height()/2))
-        pygame.gfxdraw.filled_circle(sun_img, _orig[0], _orig[1], _r, COLORS_CELESTIAL[self.timecycle])
+        pygame.gfxdraw.filled_circle(sun_img, _orig[0], _orig[1], _r, COLORS_CELESTIAL[timecycle])
         # Moon cycles
-        if self.timecycle == 3 and self.moonphase != 0:
+        if timecycle == 3 and moonphase != 0:
             _moon_phase_img = pygame.Surface([_d, _d], pygame.SRCALPHA, 32)
             _moon_phase_img = _moon_phase_img.convert_alpha()
             pygame.gfxdraw.filled_circle(_moon_phase_img, _orig[0] +
-                                         int(self.moon_offsets[self.moonphase] * _r/3), _orig[1], _r,
+                                         int(self.moon_offsets[moonphase] * _r/3), _orig[1], _r,
                                          (240, 240, 192, 255))
             sun_img.blit(_moon_phase_img, _moon_phase_img.get_rect(), None, BLEND_RGB_SUB)
-        pygame.gfxdraw.aacircle(sun_img, _orig[0], _orig[1], _r, COLORS_CELESTIAL_OUTLINE[self.timecycle])
-        _sun_rect = Rect(int(2 * W_WIDTH/3), int(W_HEIGHT/16), _d, _d)
-        self.bg_objects.append({'name': 'sun', 'image': sun_img, 'rect': _sun_rect, 'active': True})
+        pygame.gfxdraw.aacircle(sun_img, _orig[0], _orig[1], _r, COLORS_CELESTIAL_OUTLINE[timecycle])
         # Water reflection
-        _reflect_img = pygame.Surface([2 * W_WIDTH/5, W_HEIGHT/4], pygame.SRCALPHA, 32)
+        _reflect_img = pygame.Surface(_layout.reflect_size, pygame.SRCALPHA, 32)
         _reflect_img = _reflect_img.convert_alpha()
         _reflect_width = 5
         _reflect_x_offset = 0
@@ -170,16 +1245,16 @@ class Main():
         for i in range(0, int(_reflect_img.get_rect().height), 2):
             _reflect_pt = _reflect_pivot - _reflect_x_offset
             pygame.gfxdraw.hline(_reflect_img, _reflect_pt,
-                                 _reflect_pt + _reflect_width, i, COLORS_WATER_REFLECT[self.timecycle])
-            _reflect_width += random.randint(0, 4)
-            _reflect_x_offset += random.randint(0, 2)
-        _reflect_rect_offset = int(3 * W_WIDTH/5) if W_WIDTH < W_HEIGHT else int(W_WIDTH/2)
-        _reflect_rect = Rect(_reflect_rect_offset, W_HEIGHT/3,
-                             _reflect_img.get_rect().width, _reflect_img.get_rect().height)
-        self.bg_objects.append({'name': 'water_reflect', 'image': _reflect_img, 'rect': _reflect_rect, 'active': True})
+                                 _reflect_pt + _reflect_width, i, COLORS_WATER_REFLECT[timecycle])
+            _reflect_width += int(rng.integers(0, 5))
+            _reflect_x_offset += int(rng.integers(0, 3))
+        return bg_img, sun_img, _reflect_img
 
     def _create_ball(self):
-        _r = int(W_WIDTH/12) if W_WIDTH < W_HEIGHT else int(W_HEIGHT/16)
+        # The ball looks the same every round
+        if self.ball_img is not None:
+            return
+        _r = self.sim.layout.ball_radius
         _d = _r * 2
         ball_img = pygame.Surface([_d, _d], pygame.SRCALPHA, 32)
         ball_img = ball_img.convert_alpha()
@@ -199,234 +1274,473 @@ class Main():
         ball_img.blit(_ball_shadow, _ball_shadow.get_rect())
         # Borders
         pygame.gfxdraw.aacircle(ball_img, _orig[0], _orig[1], _r, BLACK)
-        _ball_coord_rect = Rect(int(W_WIDTH/2 - _r), int(W_HEIGHT/3), _d, _d)
-        _ball_hitbox = Rect(int(W_WIDTH/2 - _r), int(W_HEIGHT/3),
-                            int(ball_img.get_width() - _d/10), int(ball_img.get_height() - _d/10))
-        self.ball = {'name': 'ball', 'image': ball_img, 'rect': _ball_coord_rect, 'radius': _r, 'hitbox': _ball_hitbox,
-                     'active': True,  'velo': 1, 'accel': GRAVITY}
-
-    def _create_poles(self, pos):
-        _sizes = [int(W_HEIGHT/4), int(W_HEIGHT/3), int(W_HEIGHT/2)]
-        _starts = [int(W_HEIGHT/4), int(W_HEIGHT/3), int(W_HEIGHT/5), int(W_HEIGHT/6)]
-        _gap_size = _sizes[random.randint(0, len(_sizes) - 1)]
-        # y-position
-        _gap_start_pos = _starts[random.randint(0, len(_starts) - 1)]
-        _pole_width = W_WIDTH/8 if W_WIDTH < W_HEIGHT else int(W_HEIGHT/12)
-        # Scoring area
-        score = pygame.Surface([_pole_width/2, _gap_size], pygame.SRCALPHA, 32)
-        score = score.convert_alpha()
-        score_rect = Rect(pos + _pole_width/4, _gap_start_pos, _pole_width/2, _gap_size)
-        self.lvl_objects.append({'name': 'pole_score', 'image': score, 'rect': score_rect, 'active': True})
-        # Top pole
-        pole_top = pygame.Surface([_pole_width, _gap_start_pos], pygame.SRCALPHA, 32)
-        pole_top = pole_top.convert_alpha()
-        pole_top.fill(GREY)
-        # Bottom pole
-        _bottom_size = W_HEIGHT - (_gap_start_pos + _gap_size)
-        pole_bottom = pygame.Surface([_pole_width, _bottom_size], pygame.SRCALPHA, 32)
-        pole_bottom = pole_bottom.convert_alpha()
-        pole_bottom.fill(GREY)
-        # Shadows
-        _shadow_top = Rect(int(2 * _pole_width/3), pole_top.get_rect().y, _pole_width/3, _gap_start_pos)
-        _shadow_bottom = Rect(int(2 * _pole_width/3), pole_bottom.get_rect().y, _pole_width/3, _bottom_size)
-        pygame.gfxdraw.box(pole_top, _shadow_top, LIGHTGREY)
-        pygame.gfxdraw.box(pole_bottom, _shadow_bottom, LIGHTGREY)
-        # Borders
-        pygame.draw.rect(pole_top, BLACK, pole_top.get_rect(), 5)
-        pygame.draw.rect(pole_bottom, BLACK, pole_bottom.get_rect(), 5)
-        # Pole positions
-        pole_top_rect = Rect(pos, 0, _pole_width, _gap_start_pos)
-        pole_bottom_rect = Rect(pos, _gap_start_pos + _gap_size, _pole_width, _bottom_size)
-        self.lvl_objects.append({'name': 'pole', 'image': pole_top, 'rect': pole_top_rect, 'active': True})
-        self.lvl_objects.append({'name': 'pole', 'image': pole_bottom, 'rect': pole_bottom_rect, 'active': True})
+        self.ball_img = self._prescale(ball_img)[0]
+
+    def _pole_image(self, width, height):
+        # Poles only differ by size, so each size is drawn once and shared
+        key = (width, height)
+        img = self.pole_images.get(key)
+        if img is None:
+            img = pygame.Surface([width, height], pygame.SRCALPHA, 32)
+            img = img.convert_alpha()
+            img.fill(GREY)
+            # Shadows
+            _shadow = Rect(int(2 * width/3), 0, width/3, height)
+            pygame.gfxdraw.box(img, _shadow, LIGHTGREY)
+            # Borders
+            pygame.draw.rect(img, BLACK, img.get_rect(), max(1, self._px(5)))
+            self.pole_images[key] = img
+        return img
+
+    def _create_pole_images(self):
+        # Every top and bottom pole the gap tables can produce
+        for _gap_start_pos in self.sim.gap_starts:
+            for _gap_size in self.sim.gap_sizes:
+                self._prefetch_poles(_gap_start_pos, _gap_size)
+
+    def _prefetch_poles(self, gap_start, gap_size):
+        _pole_width = self._px(int(self.sim.pole_width))
+        self._pole_image(_pole_width, self._px(gap_start))
+        self._pole_image(_pole_width, self._px(W_HEIGHT - (gap_start + gap_size)))
+
+    def _create_poles(self, objects):
+        # Score zones are invisible and get no image
+        for o in objects:
+            if o.kind == KIND_POLE:
+                o.image = self._pole_image(self._px(o.width), self._px(o.height))
 
     def _create_txt(self):
         txt_logo_line1 = self.font.render('Bouncing', 1, GOLD)
         _rect = txt_logo_line1.get_rect()
-        _rect.centerx = W_WIDTH/2
-        _rect.y = int(W_HEIGHT/2) - int(W_HEIGHT/4)
-        self.txt.append({'name': 'logo line 1', 'image': txt_logo_line1, 'rect': _rect})
+        _rect.centerx = self.view.width/2
+        _rect.y = self.view.logo_y
+        self.txt.append(Entity(KIND_TEXT, *_rect, image=txt_logo_line1))
         # Line 2
         txt_logo_line2 = self.font.render('Beach Ball', 1, GOLD)
         _rect = txt_logo_line2.get_rect()
-        _rect.centerx = W_WIDTH/2
-        _rect.y = int(W_HEIGHT/2) - int(W_HEIGHT/4) + txt_logo_line1.get_rect().height
-        self.txt.append({'name': 'logo line 2', 'image': txt_logo_line2, 'rect': _rect})
+        _rect.centerx = self.view.width/2
+        _rect.y = self.view.logo_y + txt_logo_line1.get_rect().height
+        self.txt.append(Entity(KIND_TEXT, *_rect, image=txt_logo_line2))
         # Instructions
         txt_tap_start = self.font.render('Tap to start', 1, BLACK)
         _rect = txt_tap_start.get_rect()
-        _rect.centerx = W_WIDTH/2
-        _rect.y = int(W_HEIGHT/2) + int(W_HEIGHT/8)
-        self.txt.append({'name': 'instructions', 'image': txt_tap_start, 'rect': _rect})
+        _rect.centerx = self.view.width/2
+        _rect.y = self.view.start_y
+        self.txt.append(Entity(KIND_TEXT, *_rect, image=txt_tap_start))
 
-    def create_sounds(self):
-        pygame.mixer.init()
-        snd1 = [[100*random.randint(220,440) for x in range(2)] for x in range(2)]
-        snd2 = [[100*random.randint(660,880) for x in range(2)] for x in range(2)]
-        self.snd_bounce = pygame.sndarray.make_sound(array(snd1))
-        self.snd_fail = pygame.sndarray.make_sound(array(snd2))
-
-    def _intersect_bounds(self, rect):
-        r = self.ball['radius']
-        ball = self.ball['rect']
-        center = (ball.x + ball.width/2, ball.y + ball.height/2)
-        # left, top, bottom, right
-        return rect.collidepoint(center) or rect.collidepoint((center[0]-r, center[1])) or \
-               rect.collidepoint((center[0], center[1]-r)) or rect.collidepoint((center[0], center[1]+r)) or \
-               rect.collidepoint((center[0]+r, center[1]))
-
-    def _intersect_ball(self, p1, p2):
-        r2 = self.ball['radius'] ** 2
-        ball = self.ball['rect']
-        origin = (ball.x + ball.width/2, ball.y + ball.height/2)
-        dx1, dx2 = p1[0] - origin[0], p2[0] - origin[0]
-        dy1, dy2 = p1[1] - origin[1], p2[1] - origin[1]
-        mid_dx, mid_dy = (p1[0] + p2[0])/2 - origin[0], (p1[1] + p2[1])/2 - origin[1]
-        dist_p1 = dx1 ** 2 + dy1 ** 2
-        dist_p2 = dx2 ** 2 + dy2 ** 2
-        dist_mid = mid_dx ** 2 + mid_dy ** 2
-        return dist_p1 <= r2 or dist_p2 <= r2 or dist_mid <= r2
-
-    # Not working properly
-    def _test_intersect_ball(self, p1, p2):
-        # Formula:
-        # https://en.wikipedia.org/wiki/Distance_from_a_point_to_a_line
-        r = self.ball['radius']
-        ball = self.ball['rect']
-        origin = (ball.x + ball.width/2, ball.y + ball.height/2)
-        top = abs((p2[1] - p1[1]) * origin[0] - (p2[0] - p1[0]) * origin[1] + p2[0] * p1[1] - p2[1] * p1[0])**2
-        bottom = (p2[1]-p1[1])**2 + (p2[0]-p1[0])**2
-        print(top/bottom)
-        return top/bottom <= r
+    def _text(self, text, color):
+        # Rendered strings are cached by text and colour; they rarely change
+        key = (text, color)
+        img = self.text_images.get(key)
+        if img is None:
+            img = self.font.render(text, 1, color)
+            self.text_images[key] = img
+        return img
 
-    def collideball(self, rect):
-        ball = self.ball['rect']
-        center = (ball.x + ball.width/2, ball.y + ball.height/2)
-        #if rect.collidepoint(center):
-        #    print(rect)
-        #    print(self._test_intersect_ball((rect.x, rect.y + rect.height), (rect.x, rect.y)))
-        return self._intersect_bounds(rect) or\
-            self._intersect_ball((rect.x, rect.y), (rect.x + rect.width, rect.y)) or\
-            self._intersect_ball((rect.x + rect.width, rect.y), (rect.x + rect.width, rect.y + rect.height)) or \
-            self._intersect_ball((rect.x + rect.width, rect.y + rect.height), (rect.x, rect.y + rect.height)) or \
-            self._intersect_ball((rect.x, rect.y + rect.height), (rect.x, rect.y))
+    def _score_image(self):
+        # Rendered only when the score or timecycle colour changes
+        color = COLORS_TEXT[self.timecycle]
+        key = (self.sim.score, color)
+        if self._score_key != key:
+            self._score_img = self.font.render('Score: %d' % self.sim.score, 1, color)
+            self._score_key = key
+        return self._score_img
+
+    def create_sounds(self):
+        self.sounds = SoundBank()
 
     def reset(self):
-        self.ini_time = 0
-        self.time_passed = 0
         self.timecycle = (self.timecycle + 1) % 4
         if self.timecycle == 3:
             self.moonphase = (self.moonphase + 1) % 8
-        self.score = 0
         self.bg_objects = []
-        self.lvl_objects = []
+        self._view = None
+        self._prev = None
+        self.sim.reset()
         self._create_bg()
         self._create_ball()
 
     def update(self):
-        self.bg_objects[:] = [o for o in self.bg_objects if o['active']]
-        self.lvl_objects[:] = [o for o in self.lvl_objects if o['active']]
-        # ball handling
-        if self.state == STATE_GAMEOVER and self.ball['rect'].y < W_HEIGHT - self.ball['rect'].height/2:
-            self.ball['velo'] += self.ball['accel']
-            self.ball['rect'].y = max(self.ball['rect'].y + self.ball['velo'], -int(self.ball['rect'].height/2))
-        if self.state == STATE_RUN:
-            self.ball['velo'] += self.ball['accel']
-            self.ball['rect'].x += SPEED
-            self.ball['rect'].y = max(self.ball['rect'].y + self.ball['velo'], -int(self.ball['rect'].height/2))
-            # Determine when the poles are made
-            if self.ini_time > int(self.FPS):
-                if self.time_passed > int(3 * self.FPS/2):
-                    self._create_poles(self.ball['rect'].x + self.ball['rect'].width + W_WIDTH/2)
-                    self.time_passed = 0
-                self.time_passed += 1
-            self.ini_time += 1
-            for o in self.lvl_objects:
-                if o['name'] == 'pole' or o['name'] == 'pole_score':
-                    if self.ball['rect'].x - o['rect'].x > W_WIDTH:
-                        o['active'] = False
-                if o['name'] == 'pole':
-                    if self.collideball(o['rect']):
-                        self.state = STATE_GAMEOVER
-                        self.snd_fail.play()
-                elif o['name'] == 'pole_score':
-                    if o['active'] and self.collideball(o['rect']):
-                        self.score += 1
-                        o['active'] = False
-            for o in self.bg_objects:
-                if o['name'] == 'ground':
-                    o['rect'].x = self.ball['rect'].x - W_WIDTH/2
-                    if self.ball['rect'].colliderect(o['rect']):
-                        self.state = STATE_GAMEOVER
-                        self.snd_fail.play()
-    def draw(self):
-        self.canvas.fill(BLACK)
-        # Background
-        self.canvas.blit(self.bg, (self.bg_cam[0], self.bg_cam[1]))
-        if not self.state == STATE_GAMEOVER:
+        # One fixed tick; the ball and background positions before it are kept for interpolation
+        ball = self.sim.ball
+        self._prev = (ball.x, ball.y) if ball is not None else None
+        self._prev_cam = self.bg_cam[0]
+        events = self.sim.step()
+        self.frame += 1
+        if events & EVENT_SPAWN:
+            self._create_poles(self.sim.spawned)
+        if events & EVENT_FAIL:
+            self.sounds.play('fail')
+        if not self.sim.state == STATE_GAMEOVER:
             self.bg_cam[0] -= 1
             if self.bg_cam[0] < -W_WIDTH:
                 self.bg_cam[0] = 0
-        # Background objects
-        for o in self.bg_objects:
-            self.canvas.blit(o['image'], o['rect'])
-        # Ball
-        if self.state == STATE_RUN or self.state == STATE_GAMEOVER:
+                # The same view a tile over, so the wrap isn't interpolated as a jump
+                self._prev_cam += W_WIDTH
+        self.profiler.lap(PHASE_UPDATE)
+
+    def _ball_pos(self, alpha):
+        # Ball position between the last two ticks
+        ball = self.sim.ball
+        if self._prev is None:
+            return ball.x, ball.y
+        x, y = self._prev
+        return x + (ball.x - x) * alpha, y + (ball.y - y) * alpha
+
+    def _bg_x(self, alpha):
+        # Background scroll on screen between the last two ticks
+        return int((self._prev_cam + (self.bg_cam[0] - self._prev_cam) * alpha) * self.scale)
+
+    def _sprites(self, alpha=1.0):
+        # Poles, ball and overlay text with their screen positions, back to front
+        sprites = []
+        if self.sim.state == STATE_RUN or self.sim.state == STATE_GAMEOVER:
+            ball = self.sim.ball
+            ball_x, ball_y = self._ball_pos(alpha)
+            scale = self.scale
             # Poles
-            for o in self.lvl_objects:
-                x_dist = o['rect'].x - self.ball['rect'].x - self.ball['rect'].width/2 + W_WIDTH/2
-                self.canvas.blit(o['image'], (x_dist, o['rect'].y))
-            self.canvas.blit(self.ball['image'], (W_WIDTH/2 - self.ball['rect'].width/2, self.ball['rect'].y))
-        if self.state == STATE_INTRO:
-            for o in self.txt:
-                self.canvas.blit(o['image'], o['rect'])
+            for o in self.sim.lvl_objects:
+                if o.image is not None:
+                    x_dist = o.x - ball_x - ball.width/2 + W_WIDTH/2
+                    sprites.append((o.image, (x_dist * scale, o.y * scale)))
+            # Ball, placed by its centre
+            _r = self.ball_img.get_width()/2
+            sprites.append((self.ball_img, (W_WIDTH/2 * scale - _r, (ball_y + ball.radius) * scale - _r)))
         # Tap to retry
-        if self.state == STATE_GAMEOVER:
-            gameover_txt = self.font.render('Tap to retry', 1, COLORS_TEXT[self.timecycle])
-            gameover_txt_rect = gameover_txt.get_rect()
-            gameover_txt_rect.x = int(W_WIDTH/2 - gameover_txt_rect.width/2)
-            gameover_txt_rect.y = int(W_HEIGHT/2)
-            self.canvas.blit(gameover_txt, gameover_txt_rect)
+        if self.sim.state == STATE_GAMEOVER:
+            gameover_txt = self._text('Tap to retry', COLORS_TEXT[self.timecycle])
+            sprites.append((gameover_txt, (int(self.view.width/2 - gameover_txt.get_width()/2), self.view.retry_y)))
         # Score
-        score_txt = self.font.render('Score: ' + str(self.score), 1, COLORS_TEXT[self.timecycle])
-        score_txt_rect = score_txt.get_rect()
-        score_txt_rect.x = W_WIDTH - score_txt_rect.width
-        score_txt_rect.y = 0
-        self.canvas.blit(score_txt, score_txt_rect)
-        self.fpsClock.tick(self.FPS)
-        pygame.display.update()
-        pygame.display.flip()
+        score_txt = self._score_image()
+        sprites.append((score_txt, (self.view.width - score_txt.get_width(), 0)))
+        if self.show_profiler:
+            sprites.append((self._profiler_image(), (0, 0)))
+        return sprites
+
+    def _profiler_image(self):
+        # Refreshed twice a second so the numbers stay readable
+        if self._profiler_img is None or self.profiler.frames - self._profiler_at >= self.FPS/2:
+            st = self.profiler.stats()
+            lines = ['frame ms  p50 %(p50).1f  p95 %(p95).1f  p99 %(p99).1f' % st['frame_ms'],
+                     'dropped %d / %d' % (st['dropped'], st['frames'])]
+            lines += ['%-10s p95 %.2f' % (name, st['phases_ms'][name]['p95']) for name in PHASES]
+            images = [self.small_font.render(line, 1, WHITE) for line in lines]
+            img = pygame.Surface([max(i.get_width() for i in images) + 8, sum(i.get_height() for i in images) + 8],
+                                 pygame.SRCALPHA, 32)
+            img = img.convert_alpha()
+            img.fill((0, 0, 0, 160))
+            _y = 4
+            for i in images:
+                img.blit(i, (4, _y))
+                _y += i.get_height()
+            self._profiler_img = img
+            self._profiler_at = self.profiler.frames
+        return self._profiler_img
+
+    def _blit_scene(self, sprites, bg_x):
+        # Background, tiled twice as it scrolls
+        _y = int(self.bg_cam[1] * self.scale)
+        self.canvas.blit(self.bg, (bg_x, _y))
+        self.canvas.blit(self.bg, (bg_x + self.bg.get_width(), _y))
+        # Background objects
+        for o in self.bg_objects:
+            self.canvas.blit(o.image, (o.x, o.y))
+        self.profiler.lap(PHASE_BACKGROUND)
+        if self.sim.state == STATE_INTRO:
+            for o in self.txt:
+                self.canvas.blit(o.image, (o.x, o.y))
+        for img, pos in sprites:
+            self.canvas.blit(img, pos)
+        self.profiler.lap(PHASE_OBJECTS)
+
+    def _dirty(self, sprites, bg_x):
+        # Where the sprites are now and were last frame, plus the scrolling
+        # strip of the background if it moved; everything on a state change
+        screen = self.canvas.get_rect()
+        current = [Rect(pos, img.get_size()).inflate(2, 2).clip(screen) for img, pos in sprites]
+        view = (self.sim.state, self.timecycle)
+        if view != self._view:
+            self._view = view
+            dirty = [screen]
+        else:
+            dirty = current + self._drawn
+            if bg_x != self._drawn_cam:
+                dirty = [self.bg_strip] + [r for r in dirty if not self.bg_strip.contains(r)]
+        self._drawn = current
+        self._drawn_cam = bg_x
+        return [r for r in dirty if r.width and r.height]
+
+    def draw(self, alpha=1.0):
+        sprites = self._sprites(alpha)
+        bg_x = self._bg_x(alpha)
+        self.profiler.lap(PHASE_TEXT)
+        if self.dirty_rects:
+            dirty = self._dirty(sprites, bg_x)
+            for r in dirty:
+                self.canvas.set_clip(r)
+                self._blit_scene(sprites, bg_x)
+            self.canvas.set_clip(None)
+        else:
+            # The opaque background covers the whole view; no need to clear it
+            self._blit_scene(sprites, bg_x)
+        self.fpsClock.tick(self.max_fps)
+        self.profiler.lap(PHASE_SLEEP)
+        if self.dirty_rects:
+            pygame.display.update([r.move(self.view_rect.topleft) for r in dirty])
+        else:
+            pygame.display.flip()
+        self.profiler.lap(PHASE_PRESENT)
 
     def render(self):
-        self.update()
-        self.draw()
+        # Time since the last frame (the input poll) is charged to input
+        self.profiler.lap(PHASE_INPUT)
+        # Catch the simulation up to real time, then draw between its last two ticks
+        for i in range(self.clock.advance()):
+            if self.playback is not None:
+                self._play_actions()
+            self.update()
+        self.draw(self.clock.alpha())
+        self.profiler.end_frame()
+
+    def _play_actions(self):
+        # Feed the replay's actions due before this frame's update
+        actions = self.playback.actions
+        while self._playback_pos < len(actions) and actions[self._playback_pos][0] <= self.frame:
+            if actions[self._playback_pos][1] == ACTION_TAP:
+                self.tap()
+            else:
+                self.restart()
+            self._playback_pos += 1
+
+    def tap(self):
+        if self.replay is not None:
+            self.replay.record(self.frame, ACTION_TAP)
+        if self.sim.state == STATE_INTRO:
+            self._create_ball()
+            self.sim.start()
+            self._prev = None
+        elif self.sim.state == STATE_GAMEOVER:
+            self.reset()
+            self.sim.state = STATE_RUN
+        elif self.sim.state == STATE_RUN:
+            self.sim.flap()
+            self.sounds.play('bounce')
+
+    def restart(self):
+        if self.replay is not None:
+            self.replay.record(self.frame, ACTION_RESTART)
+        self.reset()
+        self.sim.state = STATE_RUN
+
+    def quit(self):
+        import sys
+        if self.replay is not None:
+            self.replay.frames = self.frame
+            self.replay.score = self.sim.score
+            self.replay.save(self.record_path)
+        if self.profile_path:
+            self.profiler.export(self.profile_path)
+        self.sounds.close()
+        pygame.mixer.quit()
+        pygame.quit()
+        sys.exit()
 
     def get_input(self):
         for event in pygame.event.get():
             if event.type == QUIT:
-                import sys
-                pygame.mixer.quit()
-                pygame.quit()
-                sys.exit()
+                self.quit()
+            elif event.type == KEYDOWN and event.key == K_F3:
+                self.show_profiler = not self.show_profiler
+            elif self.playback is not None:
+                continue
             elif event.type == KEYDOWN:
                 keys=pygame.key.get_pressed()
                 if keys[K_r]:
-                    self.reset()
-                    self.state = STATE_RUN
+                    self.restart()
             elif event.type == MOUSEBUTTONDOWN:
-                if self.state == STATE_INTRO:
-                    self._create_ball()
-                    self.state = STATE_RUN
-                elif self.state == STATE_GAMEOVER:
-                    self.reset()
-                    self.state = STATE_RUN
-                elif self.state == STATE_RUN:
-                    self.ball['velo'] = -GRAVITY * 10
-                    self.snd_bounce.play()
+                self.tap()
+
+def _time_us(fn, number, repeat=5, setup=None):
+    # Best of repeat runs, in microseconds per call; no garbage collection
+    # pauses inside a run, like timeit
+    import gc
+    best = float('inf')
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for j in range(number):
+                fn()
+            best = min(best, (time.perf_counter() - start) / number)
+        finally:
+            gc.enable()
+    return best * 1e6
+
+
+def benchmark_suite(pole_counts=(30, 300, 3000), frames=10000, resolution=None):
+    # Hot paths of the game in microseconds per call (run_* in total ms), for
+    # comparing against a saved baseline. Needs pygame initialised; the
+    # dummy video and audio drivers are fine. The frame limiter is off.
+    results = {}
+    m = Main(seed=0, max_fps=0, resolution=resolution)
+    sim = m.sim
+    m.tap()
+    # Collision against a pole next to the ball
+    pole = Entity(KIND_POLE, sim.ball.x + sim.ball.width, 0, int(sim.pole_width), W_HEIGHT)
+    results['collideball'] = _time_us(lambda: sim.collideball(pole), 100000)
+    # One update with count pole objects live, the ball held in place between gaps
+    for count in pole_counts:
+        def crowd():
+            sim.restart()
+            _crowd(sim, count)
+        def update():
+            sim.ball.x -= SPEED
+            m.update()
+        results['update_%d_poles' % count] = _time_us(update, 2000, repeat=10, setup=crowd)
+    # A mid-game frame
+    m.reset()
+    sim.state = STATE_RUN
+    for i in range(300):
+        if gap_policy(sim.ball.y, sim.ball.velo, *sim.next_gap()):
+            sim.flap()
+        m.update()
+    results['draw'] = _time_us(m.draw, 200)
+    # Asset builds, uncached
+    results['create_bg'] = _time_us(lambda: (m.scenes.clear(), m._create_bg()), 5)
+    results['create_bg_cached'] = _time_us(m._create_bg, 50)
+    results['create_ball'] = _time_us(lambda: (setattr(m, 'ball_img', None), m._create_ball()), 50)
+    spawn = sim.add_poles(sim.ball.x + W_WIDTH, sim.gap_starts[0], sim.gap_sizes[1])
+    results['create_poles'] = _time_us(lambda: m._create_poles(spawn), 10000)
+    results['create_poles_uncached'] = _time_us(lambda: (m.pole_images.clear(), m._create_poles(spawn)), 200)
+    # A scripted session: the example bot plays, retrying whenever it loses
+    def run():
+        m.restart()
+        for i in range(frames):
+            if sim.state == STATE_GAMEOVER or gap_policy(sim.ball.y, sim.ball.velo, *sim.next_gap()):
+                m.tap()
+            m.update()
+            m.draw()
+    results['run_%d_frames_ms' % frames] = _time_us(run, 1, repeat=1) / 1000
+    m.sounds.close()
+    return results
+
+
+def compare_benchmarks(results, baseline, tolerance=.2):
+    # (name, baseline, result) for every timing more than tolerance slower
+    return [(name, baseline[name], value) for name, value in sorted(results.items())
+            if name in baseline and value > baseline[name] * (1 + tolerance)]
+
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Bouncing Beach Ball')
+    parser.add_argument('--bench-batch', type=int, metavar='N',
+                        help='time N batched games against the scalar loop and exit')
+    parser.add_argument('--bench-broadphase', action='store_true',
+                        help='time a frame against the number of live poles and exit')
+    parser.add_argument('--bench', metavar='FILE',
+                        help='time the hot paths (dummy display and audio unless set), save them as JSON and exit')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='with --bench: compare against an earlier --bench file, exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=.2,
+                        help='with --baseline: allowed slowdown, as a fraction (default 0.2)')
+    parser.add_argument('--bench-timestep', action='store_true',
+                        help='time the simulation speed with rendering throttled and exit')
+    parser.add_argument('--max-fps', type=int, default=60, metavar='N',
+                        help='render at most N frames a second, 0 for no limit (physics stays at 60 ticks/s)')
+    parser.add_argument('--tournament', type=int, metavar='EPISODES',
+                        help='score a bot over EPISODES seeded games (from --seed, default 0) and exit')
+    parser.add_argument('--policy', metavar='MODULE:FUNCTION',
+                        help='with --tournament: policy(y, velo, gap_y, gap_h) returning True to flap')
+    parser.add_argument('--processes', type=int, help='with --tournament: worker processes (default: all cores)')
+    parser.add_argument('--resolution', type=lambda v: tuple(int(n) for n in v.lower().split('x')), metavar='WxH',
+                        help='window size, e.g. 1920x1080; the game is drawn to fit, letterboxed')
+    parser.add_argument('--fullscreen', action='store_true',
+                        help='fill the screen, scaled in hardware unless --resolution is given')
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help='redraw and present only the regions that changed each frame')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='save frame timings on quit (.csv per frame, otherwise a JSON summary); F3 shows them')
+    parser.add_argument('--asset-cache', metavar='DIR', help='keep generated backgrounds as PNGs in DIR')
+    parser.add_argument('--seed', type=int, help='seed for the course and scenery')
+    parser.add_argument('--record', metavar='FILE', help='save a replay of the session on quit')
+    parser.add_argument('--replay', metavar='FILE', help='play back a recorded session')
+    parser.add_argument('--headless', action='store_true',
+                        help='with --replay: fast-forward without a window and check the recorded score')
+    args = parser.parse_args()
+    if args.seed is not None and not 0 <= args.seed < 2 ** 64:
+        parser.error('--seed must be in 0..2**64-1')
+    if args.replay and args.headless:
+        replay = Replay.load(args.replay)
+        start = time.perf_counter()
+        sim = replay.play()
+        elapsed = time.perf_counter() - start
+        print('frames: %d  score: %d  recorded score: %d  %s  (%.0f frames/s)' % (
+            replay.frames, sim.score, replay.score, 'OK' if sim.score == replay.score else 'MISMATCH',
+            replay.frames / max(elapsed, 1e-9)))
+        raise SystemExit(sim.score != replay.score)
+    if args.bench_broadphase:
+        for row in benchmark_broadphase():
+            print('objects: %(objects)6d  step: %(step_us)8.1fus  full scan: %(full_scan_us)10.1fus' % row)
+        raise SystemExit
+    if args.bench:
+        import os, json, platform
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        pygame.init()
+        results = benchmark_suite(resolution=args.resolution)
+        with open(args.bench, 'w') as f:
+            json.dump({'python': platform.python_version(), 'pygame': pygame.version.ver, 'numpy': np.__version__,
+                       'platform': platform.platform(), 'results': results}, f, indent=2)
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+        for name, value in sorted(results.items()):
+            line = '%-24s %12.2f' % (name, value)
+            if name in baseline:
+                line += '  baseline %12.2f  %+6.1f%%' % (baseline[name], 100.0 * (value / baseline[name] - 1))
+            print(line)
+        regressions = compare_benchmarks(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print('REGRESSION %s: %.2f -> %.2f' % (name, before, after))
+        raise SystemExit(1 if regressions else 0)
+    if args.tournament:
+        policy = gap_policy
+        if args.policy:
+            import importlib
+            module, name = args.policy.split(':')
+            policy = getattr(importlib.import_module(module), name)
+        result = tournament(policy, args.tournament, args.seed or 0, args.processes)
+        print('episodes: %(episodes)d on %(processes)d processes, %(episodes_per_s).1f episodes/s, '
+              '%(frames_per_s).0f frames/s' % result)
+        print('score mean: %(mean).2f  std: %(std).2f  min: %(min)d  p10: %(p10)g  p50: %(p50)g  '
+              'p90: %(p90)g  p99: %(p99)g  max: %(max)d  capped: %(capped)d' % result)
+        # At most 20 rows of equal integer ranges
+        width = int(math.ceil((result['max'] - result['min'] + 1) / 20.0))
+        counts = np.bincount((result['scores'] - result['min']) // width)
+        for i, count in enumerate(counts):
+            low = result['min'] + i * width
+            print('%5d-%-5d %6d %s' % (low, low + width - 1, count,
+                                     '#' * int(math.ceil(60.0 * count / result['episodes']))))
+        raise SystemExit
+    if args.bench_timestep:
+        for row in benchmark_timestep():
+            print('render: %(render_ms)3dms  fps: %(render_fps)5.1f  ticks/s fixed: %(fixed_ticks_per_s)5.1f'
+                  '  coupled: %(coupled_ticks_per_s)5.1f  dropped ticks: %(dropped_ticks)d' % row)
+        raise SystemExit
+    if args.bench_batch:
+        for k, v in benchmark_batch(args.bench_batch).items():
+            print('%s: %s' % (k, round(v, 1)))
+        raise SystemExit
     pygame.init()
-    f = Main()
+    f = Main(dirty_rects=args.dirty_rects, seed=args.seed, record=args.record,
+             replay=Replay.load(args.replay) if args.replay else None, profile=args.profile,
+             asset_cache=args.asset_cache, max_fps=args.max_fps, resolution=args.resolution,
+             fullscreen=args.fullscreen)
+    f.profiler.start()
     while True:
         f.render()
         f.get_input()